@@ -1,64 +1,68 @@
-import cv2
 import time
 import asyncio
 from fastapi import FastAPI, Request, File, UploadFile
-from fastapi.responses import StreamingResponse, JSONResponse
+from fastapi.responses import StreamingResponse, JSONResponse, FileResponse, Response
 from fastapi.staticfiles import StaticFiles
 from fastapi.templating import Jinja2Templates
 from contextlib import asynccontextmanager
-from core_logic import load_models, CaptionGenerator, SecuritySystem
+from core_logic import FrameBuffer, SnapshotManager
+from frame_bus import create_bus, InProcessBus
+from nodes import CaptureNode, ServingState, build_inference
 from gtts import gTTS
 import io
 from deep_translator import GoogleTranslator
 from pydantic import BaseModel
+from typing import Optional
 import shutil
 import os
 
+# Bus connecting capture, inference and web workers. With the default
+# in-process bus this process runs every role itself; with an ipc:// or
+# tcp:// URL it is a stateless web worker (see nodes.py), so uvicorn can
+# run several of them.
+BUS_URL = os.environ.get("MUSEUMGUARD_BUS", "inproc")
+# By default capture and inference only run while a stream is viewed or the
+# autopilot is on; set this to keep them (and the caption archive) running always
+ALWAYS_ON = os.environ.get("MUSEUMGUARD_ALWAYS_ON", "").lower() in ["1", "true", "yes"]
+# Uploaded videos are opened by path by the capture node, so with capture on
+# another host this must be shared storage mounted at the same path
+UPLOAD_DIR = os.environ.get("MUSEUMGUARD_UPLOAD_DIR", "temp")
+
 # Global variables
-processor = None
-model = None
-device = None
-caption_generator = None
-security_system = None
-camera = None
-
-# Security Mode State
-security_mode = "webcam" # 'webcam' or 'video'
-uploaded_video_path = None
-security_video_capture = None
+bus = None
+serving = None
+local_roles = []
+local_security_system = None  # Only set when this process runs inference itself
+frame_buffer = FrameBuffer()
+snapshot_manager = None
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
-    global processor, model, device, caption_generator, security_system, camera
+    global bus, serving, local_roles, local_security_system, snapshot_manager
     # Startup
-    print("Lifespan: Loading models...")
-    processor, model, device = load_models()
-    
-    # Initialize Security System
-    print("Lifespan: Initializing Security System...")
-    security_system = SecuritySystem(device)
-
-    if processor and model:
-        print("Lifespan: Models loaded. Initializing CaptionGenerator...")
-        caption_generator = CaptionGenerator(processor, model, device)
-        camera = cv2.VideoCapture(0) # Try default camera
-        if not camera.isOpened():
-             print("Warning: Could not open default camera 0. Trying 1...")
-             camera = cv2.VideoCapture(1)
-        
-        if not camera.isOpened():
-             print("Error: Could not open any camera.")
+    snapshot_manager = SnapshotManager("snapshots")
+    bus = create_bus(BUS_URL)
+
+    if isinstance(bus, InProcessBus):
+        print("Lifespan: Starting capture and inference in-process...")
+        node, caption_generator, local_security_system = build_inference(bus, always_on=ALWAYS_ON)
+        local_roles = [
+            CaptureNode(bus, "webcam", "auto", always_on=ALWAYS_ON),
+            CaptureNode(bus, "video", always_on=ALWAYS_ON),
+            node,
+            local_security_system,
+        ] + ([caption_generator] if caption_generator else [])
     else:
-        print("Lifespan: Failed to load models.")
+        print(f"Lifespan: Serving from bus {BUS_URL}")
+
+    serving = ServingState(bus, frame_buffer)
 
     yield
     # Shutdown
-    if caption_generator:
-        caption_generator.stop()
-    if camera:
-        camera.release()
-    if security_video_capture:
-        security_video_capture.release()
+    serving.stop()
+    for role in local_roles:
+        role.stop()
+    bus.close()
 
 app = FastAPI(lifespan=lifespan)
 
@@ -73,6 +77,12 @@ class SpeakRequest(BaseModel):
     text: str
     lang: str
 
+class SearchRequest(BaseModel):
+    query: str
+    top_k: int = 10
+    start: Optional[float] = None
+    end: Optional[float] = None
+
 class EmailConfig(BaseModel):
     sender: str
     password: str
@@ -80,65 +90,43 @@ class EmailConfig(BaseModel):
 
 def gen_frames_caption():
     """Generates JPEG frames for the Captioning page (Webcam Only)."""
-    global camera, caption_generator
-    
-    while True:
-        if not camera or not camera.isOpened():
-            time.sleep(1)
-            continue
-            
-        success, frame = camera.read()
-        if not success:
-            continue
-            
-        if caption_generator:
-            caption_generator.update_frame(frame)
-        
-        ret, buffer = cv2.imencode('.jpg', frame)
-        frame_bytes = buffer.tobytes()
-        yield (b'--frame\r\n'
-               b'Content-Type: image/jpeg\r\n\r\n' + frame_bytes + b'\r\n')
+    global bus, serving
+    serving.add_viewer("caption")
+    subscription = bus.subscribe("frames/webcam")
+    try:
+        while True:
+            message = subscription.recv(timeout=1.0)
+            if message is None:
+                continue
+            yield (b'--frame\r\n'
+                   b'Content-Type: image/jpeg\r\n\r\n' + message.jpeg + b'\r\n')
+    finally:
+        subscription.close()
+        serving.remove_viewer("caption")
 
 def gen_frames_security():
-    """Generates Annotated JPEG frames for the Security page (Webcam or Video)."""
-    global camera, security_system, security_mode, security_video_capture, uploaded_video_path
-    
-    while True:
-        frame = None
-        
-        if security_mode == "webcam":
-             if not camera or not camera.isOpened():
-                time.sleep(1)
-                continue
-             success, frame = camera.read()
-             if not success:
-                 continue
-        
-        elif security_mode == "video":
-            if not security_video_capture:
-                 if uploaded_video_path and os.path.exists(uploaded_video_path):
-                     security_video_capture = cv2.VideoCapture(uploaded_video_path)
-                 else:
-                     time.sleep(1)
-                     continue
-            
-            success, frame = security_video_capture.read()
-            if not success:
-                # Loop video
-                security_video_capture.set(cv2.CAP_PROP_POS_FRAMES, 0)
+    """Generates Annotated JPEG frames for the Security page (selected source only)."""
+    global bus, serving
+    serving.add_viewer("security")
+    source = None
+    subscription = None
+    try:
+        while True:
+            # Follow source switches made through any web worker
+            if serving.get_state("source") != source:
+                if subscription:
+                    subscription.close()
+                source = serving.get_state("source")
+                subscription = bus.subscribe(f"results/{source}")
+            message = subscription.recv(timeout=1.0)
+            if message is None:
                 continue
-        
-        if frame is not None and security_system:
-             # Run Inference
-             annotated_frame, detected, info = security_system.process_frame(frame)
-             
-             # Encode
-             ret, buffer = cv2.imencode('.jpg', annotated_frame)
-             frame_bytes = buffer.tobytes()
-             yield (b'--frame\r\n'
-                    b'Content-Type: image/jpeg\r\n\r\n' + frame_bytes + b'\r\n')
-        else:
-            time.sleep(0.1)
+            yield (b'--frame\r\n'
+                   b'Content-Type: image/jpeg\r\n\r\n' + message.jpeg + b'\r\n')
+    finally:
+        if subscription:
+            subscription.close()
+        serving.remove_viewer("security")
 
 
 @app.get("/")
@@ -163,29 +151,9 @@ def video_feed_security():
 
 @app.get("/stats")
 def get_stats():
-    """Returns current caption and security status."""
-    global caption_generator, security_system
-    
-    caption = "Initializing..."
-    if caption_generator:
-        caption = caption_generator.get_caption()
-        
-    status = "Normal"
-    if security_system and security_system.last_detection:
-        # Check if last detection was recent (within 2 seconds)
-        # We need to implement 'last_detection_time' in SecuritySystem really, 
-        # but for now let's just assume if it returns info, it's detecting.
-        # Although process_frame updates continuously.
-        # Let's add a property to check status.
-        pass
-
-    # Quick fix: SecuritySystem doesn't store state nicely yet, let's just default to 'Normal'
-    # and let the frontend poll a dedicated security endpoint or we update SecuritySystem
-    
-    security_status = "Normal"
-    # Actually, let's create a dedicated /security_status endpoint or just hack it here
-    pass
-
+    """Returns current caption."""
+    global serving
+    caption = serving.get_caption() or "Initializing..."
     return JSONResponse({
         "caption": caption
     })
@@ -193,29 +161,59 @@ def get_stats():
 @app.get("/security_status")
 def get_security_status():
     """Returns security system state and autopilot status."""
-    global security_system
+    global serving
     status = "Normal"
-    autopilot = False
-    
-    if security_system:
-        # We need to look at the last frame result. 
-        # Since process_frame returns it, maybe we store it in the class?
-        # Let's modify SecuritySystem to store 'current_state'
-        if security_system.current_state:
-            status = security_system.current_state
-        autopilot = security_system.autopilot_active
-            
+    result = serving.get_latest_result(serving.get_state("source"))
+    # A result older than a couple of seconds means the source went quiet
+    if result.get("state") and time.time() - result.get("received", 0) < 2.0:
+        status = result["state"]
+    autopilot = bool(serving.get_state("autopilot"))
     return {"status": status, "autopilot": autopilot}
 
+@app.get("/alert_stats")
+async def get_alert_stats():
+    """Returns per camera/zone event, alert and suppression counts from every inference node."""
+    global serving
+    replies = await asyncio.to_thread(serving.request, "alert_stats", gather=True)
+    if not replies:
+        return {"status": "error", "message": "System not ready"}
+    streams = [stream for reply in replies for stream in reply.get("streams", [])]
+    return {"status": "success", "streams": streams}
+
 @app.post("/toggle_autopilot")
 async def toggle_autopilot(data: dict):
-    global security_system
-    if security_system:
-        security_system.autopilot_active = data.get("active", False)
-        mode = "ON" if security_system.autopilot_active else "OFF"
-        print(f"Auto Pilot switched {mode}")
-        return {"status": "success", "active": security_system.autopilot_active}
-    return {"status": "error", "message": "System not ready"}
+    global serving
+    active = bool(data.get("active", False))
+    serving.set_state("autopilot", active)
+    print(f"Auto Pilot switched {'ON' if active else 'OFF'}")
+    return {"status": "success", "active": active}
+
+@app.post("/search")
+async def search_footage(request: SearchRequest):
+    """Finds archived frames whose captions match a free-text query, e.g. 'person near the lamp'."""
+    global serving
+    # A blank query embeds to a zero vector, which would rank everything at 0.0
+    if not request.query.strip():
+        return {"status": "error", "message": "Search query must not be empty"}
+    # Every captioning node keeps its own archive, so merge their best matches
+    replies = await asyncio.to_thread(serving.request, "search", gather=True, capability="captioning",
+                                      query=request.query, top_k=request.top_k,
+                                      start=request.start, end=request.end)
+    replies = [reply for reply in replies if reply.get("status") == "success"] if replies else []
+    if not replies:
+        return {"status": "error", "message": "System not ready"}
+    results = sorted((r for reply in replies for r in reply["results"]), key=lambda r: r["score"], reverse=True)
+    return {"status": "success", "total": sum(reply["total"] for reply in replies),
+            "results": results[:max(1, request.top_k)]}
+
+@app.get("/search/similar/{entry_id}")
+async def search_similar(entry_id: int, node_id: Optional[str] = None, top_k: int = 10,
+                         start: Optional[float] = None, end: Optional[float] = None):
+    """Finds archived frames that look like an existing archive entry (node_id as returned by /search)."""
+    global serving
+    result = await asyncio.to_thread(serving.request, "search_similar", entry_id=entry_id, node_id=node_id,
+                                     top_k=top_k, start=start, end=end)
+    return result or {"status": "error", "message": "System not ready"}
 
 @app.post("/translate")
 async def translate_text(request: TranslationRequest):
@@ -240,28 +238,34 @@ async def speak_text(request: SpeakRequest):
 
 @app.post("/configure_email")
 async def configure_email(config: EmailConfig):
-    global security_system
-    if security_system:
-        security_system.email_notifier.configure(config.sender, config.password, config.receiver)
+    global local_security_system
+    if local_security_system:
+        local_security_system.email_notifier.configure(config.sender, config.password, config.receiver)
         return {"status": "success", "message": "Email configured"}
-    return {"status": "error", "message": "System not ready"}
+    # Credentials never travel over the bus; each inference node reads its own
+    return {"status": "error",
+            "message": "Set MUSEUMGUARD_SMTP_SENDER/PASSWORD/RECEIVER on each inference node"}
 
 @app.post("/upload_video")
 async def upload_video(file: UploadFile = File(...)):
-    global security_mode, uploaded_video_path, security_video_capture
+    global serving
     try:
-        temp_dir = "temp"
-        if not os.path.exists(temp_dir):
-            os.makedirs(temp_dir)
+        if not os.path.exists(UPLOAD_DIR):
+            os.makedirs(UPLOAD_DIR)
             
-        uploaded_video_path = os.path.join(temp_dir, file.filename)
+        # Absolute, so a capture node with another working directory can open it
+        uploaded_video_path = os.path.abspath(os.path.join(UPLOAD_DIR, os.path.basename(file.filename)))
         with open(uploaded_video_path, "wb") as buffer:
             shutil.copyfileobj(file.file, buffer)
             
-        security_mode = "video"
-        if security_video_capture:
-            security_video_capture.release()
-        security_video_capture = None # Will be re-init in loop
+        result = await asyncio.to_thread(serving.request, "open_source", camera_id="video",
+                                         source=uploaded_video_path)
+        if result is None:
+            return {"status": "error", "message": "No capture node for 'video' responded"}
+        if result.get("status") != "success":
+            return {"status": "error",
+                    "message": result.get("message", "") + " (is MUSEUMGUARD_UPLOAD_DIR shared storage?)"}
+        serving.set_state("source", "video")
         
         return {"status": "success", "message": "Video uploaded and mode switched"}
     except Exception as e:
@@ -269,20 +273,74 @@ async def upload_video(file: UploadFile = File(...)):
 
 @app.post("/switch_source")
 async def switch_source(source: str): # 'webcam' or 'video'
-    global security_mode
+    global serving
     if source in ["webcam", "video"]:
-        security_mode = source
+        serving.set_state("source", source)
         return {"status": "success", "mode": source}
     return {"status": "error"}
 
 @app.post("/snapshot")
-def save_snapshot():
-    # Only for webcam snapshot
-    global camera
-    if camera and camera.isOpened():
-        success, frame = camera.read()
-        if success:
-            filename = f"snapshot_{int(time.time())}.jpg"
-            cv2.imwrite(filename, frame)
-            return {"status": "success", "filename": filename}
-    return {"status": "error", "message": "Could not take snapshot"}
+async def save_snapshot(variant: str = "raw", source: str = "webcam"): # 'raw', 'annotated' or 'both'
+    """Saves the latest buffered frame(s) without reading from the camera."""
+    global frame_buffer, snapshot_manager
+    if variant not in ["raw", "annotated", "both"] or not snapshot_manager:
+        return {"status": "error", "message": "Could not take snapshot"}
+
+    frames = []
+    if variant in ["raw", "both"]:
+        frames.append(("raw", frame_buffer.get_raw(source)))
+    if variant in ["annotated", "both"]:
+        frames.append(("annotated", frame_buffer.get_annotated(source)))
+
+    filenames = []
+    for kind, frame in frames:
+        if frame is None:
+            continue
+        filename = await asyncio.to_thread(snapshot_manager.save, frame, kind)
+        if filename:
+            filenames.append(filename)
+
+    if not filenames:
+        return {"status": "error", "message": "No recent frame available"}
+    return {"status": "success", "filename": filenames[0], "filenames": filenames}
+
+@app.get("/snapshots")
+def list_snapshots(offset: int = 0, limit: int = 20):
+    """Pages through saved snapshots, newest first."""
+    global snapshot_manager
+    if not snapshot_manager:
+        return {"total": 0, "items": []}
+
+    offset = max(0, offset)
+    limit = min(max(1, limit), 100)
+    total, filenames = snapshot_manager.list(offset, limit)
+    items = []
+    for filename in filenames:
+        timestamp, kind = snapshot_manager.describe(filename)
+        items.append({
+            "filename": filename,
+            "kind": kind,
+            "timestamp": timestamp,
+            "url": f"/snapshots/{filename}",
+            "thumbnail_url": f"/snapshots/{filename}/thumbnail",
+        })
+    return {"total": total, "offset": offset, "limit": limit, "items": items}
+
+@app.get("/snapshots/{filename}")
+def get_snapshot(filename: str):
+    global snapshot_manager
+    if not snapshot_manager or not snapshot_manager.exists(filename):
+        return JSONResponse(status_code=404, content={"error": "Snapshot not found"})
+    return FileResponse(snapshot_manager.path(filename), media_type="image/jpeg")
+
+@app.get("/snapshots/{filename}/thumbnail")
+async def get_snapshot_thumbnail(filename: str):
+    global snapshot_manager
+    data = None
+    if snapshot_manager:
+        data = await asyncio.to_thread(snapshot_manager.get_thumbnail, filename)
+    if data is None:
+        return JSONResponse(status_code=404, content={"error": "Snapshot not found"})
+    # Snapshots are never rewritten, so thumbnails can be cached indefinitely
+    return Response(content=data, media_type="image/jpeg",
+                    headers={"Cache-Control": "public, max-age=31536000, immutable"})
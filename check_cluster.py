@@ -0,0 +1,101 @@
+import os
+import sys
+import glob
+import time
+import argparse
+import subprocess
+from collections import defaultdict
+from core_logic import FrameBuffer
+from frame_bus import create_bus
+from nodes import ServingState
+
+def start(role, bus_url, *args):
+    command = [sys.executable, "nodes.py", role, "--bus", bus_url] + list(args)
+    print("Starting:", " ".join(command))
+    return subprocess.Popen(command)
+
+def check_cluster(bus_url, cameras, video, inference_nodes, seconds, caption):
+    """Starts a broker, one capture node per camera and several inference nodes
+    as local processes, then checks that every camera is analyzed by exactly
+    one inference node and that every node answers broadcast requests."""
+    processes = [start("broker", bus_url)]
+    time.sleep(1)
+    for camera_id in cameras:
+        # The same recording stands in for every live camera
+        processes.append(start("capture", bus_url, "--camera-id", camera_id, "--source", video, "--as-live"))
+    for _ in range(inference_nodes):
+        processes.append(start("inference", bus_url, *([] if caption else ["--no-caption"])))
+
+    bus = create_bus(bus_url)
+    serving = ServingState(bus, FrameBuffer())
+    serving.add_viewer("security")
+    try:
+        # Model loading can take a while
+        deadline = time.time() + 180
+        while len(serving.cluster.live_nodes("inference")) < inference_nodes:
+            if time.time() > deadline:
+                print(f"Only {len(serving.cluster.live_nodes('inference'))}/{inference_nodes} inference nodes came up")
+                return False
+            time.sleep(1)
+        print(f"{inference_nodes} inference nodes live, waiting for camera ownership to settle...")
+        time.sleep(3)
+
+        processed = defaultdict(set)
+        subscription = bus.subscribe("results/", conflate=False)
+        end = time.time() + seconds
+        while time.time() < end:
+            message = subscription.recv(timeout=0.5)
+            if message is not None:
+                processed[message.header.get("camera_id")].add(message.header.get("node_id"))
+        subscription.close()
+
+        success = True
+        for camera_id in cameras:
+            owners = sorted(processed.get(camera_id, []))
+            print(f"Camera {camera_id}: analyzed by {owners or 'no node'}")
+            if len(owners) != 1:
+                success = False
+
+        replies = serving.request("alert_stats", gather=True) or []
+        print(f"alert_stats: {len(replies)}/{inference_nodes} inference nodes replied")
+        if len(replies) != inference_nodes:
+            success = False
+
+        captioners = [node_id for node_id, heartbeat in serving.cluster.live_nodes("inference").items()
+                      if heartbeat.get("captioning")]
+        print(f"Captioning nodes: {captioners or 'none'}")
+        if caption and len(captioners) != 1:
+            # Every node shares ./archive here, so only one may hold its lock
+            success = False
+        return success
+    finally:
+        serving.remove_viewer("security")
+        serving.stop()
+        bus.close()
+        for process in reversed(processes):
+            process.terminate()
+        for process in processes:
+            process.wait()
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run a local multi-process cluster and verify camera sharding.")
+    parser.add_argument("--bus", default="ipc:///tmp/museumguard-check")
+    parser.add_argument("--cameras", default="webcam,lobby,gallery", help="comma-separated camera ids")
+    parser.add_argument("--video", default=None, help="video file each capture node plays (default: first in temp/)")
+    parser.add_argument("--inference", type=int, default=2, help="number of inference processes")
+    parser.add_argument("--seconds", type=float, default=10, help="how long to collect results")
+    parser.add_argument("--caption", action="store_true", help="also load BLIP and check that one node captions")
+    args = parser.parse_args()
+
+    os.chdir(os.path.dirname(os.path.abspath(__file__)))
+    video = args.video or (sorted(glob.glob("temp/*.mp4")) or [None])[0]
+    if not video:
+        print("No video found; pass --video")
+        sys.exit(1)
+
+    if check_cluster(args.bus, args.cameras.split(","), video, args.inference, args.seconds, args.caption):
+        print("Verification SUCCESS")
+        sys.exit(0)
+    else:
+        print("Verification FAILED")
+        sys.exit(1)
@@ -6,11 +6,22 @@ import time
 from PIL import Image
 from threading import Thread, Lock
 from queue import Queue
+from collections import OrderedDict
+import itertools
+import json
+import re
+import numpy as np
 import smtplib
 from email.message import EmailMessage
 from ultralytics import YOLO
 import os
 
+try:
+    import fcntl  # POSIX file locks
+except ImportError:
+    fcntl = None
+    import msvcrt  # Windows file locks
+
 def setup_logging():
     """Configure logging with basic formatting"""
     logging.basicConfig(
@@ -24,12 +35,12 @@ logger = setup_logging()
 class EmailNotifier:
     def __init__(self):
         # HARDCODED CREDENTIALS - REPLACE WITH YOUR REAL SENDER DETAILS
-        self.sender_email = "villwin11@gmail.com" # Placeholder
-        self.app_password = "wsju eiov nied sxkl" # Placeholder
-        self.receiver_email = "harishs1520@gmail.com"
-        
-        self.last_email_time = 0
-        self.cooldown = 30  # Seconds between emails
+        # Each node can override them through its own environment, so they
+        # never have to travel over the bus
+        self.sender_email = os.environ.get("MUSEUMGUARD_SMTP_SENDER", "villwin11@gmail.com") # Placeholder
+        self.app_password = os.environ.get("MUSEUMGUARD_SMTP_PASSWORD", "wsju eiov nied sxkl") # Placeholder
+        self.receiver_email = os.environ.get("MUSEUMGUARD_SMTP_RECEIVER", "harishs1520@gmail.com")
+        # Rate limiting is per camera/zone and lives in AlertAggregator
 
     def configure(self, sender, password, receiver):
         # Override if needed, but defaults are set
@@ -37,17 +48,14 @@ class EmailNotifier:
         self.app_password = password
         self.receiver_email = receiver
 
-    def send_alert(self, image_frame, detection_details):
+    def send_alert(self, image_frame, detection_details, subject='SECURITY ALERT: Suspicious Activity Detected'):
         if self.app_password == "xxxx xxxx xxxx xxxx":
              logger.warning("Email Alert Triggered but Sender Password is NOT set in core_logic.py")
              return False, "Sender config missing"
 
-        if time.time() - self.last_email_time < self.cooldown:
-            return False, "Cooldown active"
-
         try:
             msg = EmailMessage()
-            msg['Subject'] = 'SECURITY ALERT: Suspicious Activity Detected'
+            msg['Subject'] = subject
             msg['From'] = self.sender_email
             msg['To'] = self.receiver_email
             msg.set_content(f"Suspicious activity detected!\n\nDetails: {detection_details}\nTime: {time.ctime()}")
@@ -62,15 +70,203 @@ class EmailNotifier:
                 smtp.login(self.sender_email, self.app_password)
                 smtp.send_message(msg)
 
-            self.last_email_time = time.time()
             logger.info(f"Alert email sent to {self.receiver_email}")
             return True, "Email sent"
         except Exception as e:
             logger.error(f"Failed to send email: {e}")
             return False, str(e)
 
+def box_iou(a, b):
+    """Intersection-over-union of two (x1, y1, x2, y2) boxes."""
+    ix1, iy1 = max(a[0], b[0]), max(a[1], b[1])
+    ix2, iy2 = min(a[2], b[2]), min(a[3], b[3])
+    inter = max(0, ix2 - ix1) * max(0, iy2 - iy1)
+    union = (a[2] - a[0]) * (a[3] - a[1]) + (b[2] - b[0]) * (b[3] - b[1]) - inter
+    return inter / union if union > 0 else 0.0
+
+class AlertAggregator:
+    """Merges detections into digest alerts with per-camera/zone rate limits.
+
+    Detections for a (camera, zone) are collected for `window` seconds and sent
+    as one alert carrying the best-confidence frame. After an alert that key is
+    quiet for `cooldown` seconds, and subjects already reported are suppressed
+    until they have been out of view for `subject_ttl` seconds. Sending happens
+    on a background thread so SMTP never blocks inference.
+    """
+    def __init__(self, notifier, window=5.0, cooldown=30.0, subject_ttl=60.0, subject_iou=0.4):
+        self.notifier = notifier
+        self.window = window
+        self.cooldown = cooldown
+        self.subject_ttl = subject_ttl
+        self.subject_iou = subject_iou
+
+        self.lock = Lock()
+        self.pending = {}      # key -> open digest window
+        self.last_alert = {}   # key -> time of last sent alert
+        self.subjects = {}     # key -> list of [box, last_seen] already reported
+        self.stats = {}        # key -> counters
+
+        self.running = True
+        self.thread = Thread(target=self._flush_worker)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def _stats_for(self, key):
+        if key not in self.stats:
+            self.stats[key] = {"events": 0, "alerts_sent": 0, "alerts_failed": 0,
+                               "suppressed_cooldown": 0, "suppressed_subject": 0}
+        return self.stats[key]
+
+    def _is_known_subject(self, key, box, now):
+        for subject in self.subjects.get(key, []):
+            if now - subject[1] < self.subject_ttl and box_iou(subject[0], box) >= self.subject_iou:
+                subject[1] = now
+                return True
+        return False
+
+    def submit(self, frame, detections, camera_id="default", zone="default", timestamp=None):
+        """Records a positive frame. detections is a list of (box, confidence).
+
+        Returns the outcome: 'cooldown', 'same_subject' or 'queued'. The frame is
+        only copied when it becomes the best frame of its window.
+        """
+        now = time.time() if timestamp is None else timestamp
+        key = (camera_id, zone)
+        with self.lock:
+            stats = self._stats_for(key)
+            stats["events"] += 1
+
+            if now - self.last_alert.get(key, 0) < self.cooldown:
+                stats["suppressed_cooldown"] += 1
+                return "cooldown"
+
+            new_boxes = [box for box, _ in detections if not self._is_known_subject(key, box, now)]
+            if detections and not new_boxes:
+                stats["suppressed_subject"] += 1
+                return "same_subject"
+
+            digest = self.pending.get(key)
+            if digest is None:
+                digest = {"start": now, "end": now, "count": 0, "best_conf": -1.0,
+                          "best_frame": None, "boxes": []}
+                self.pending[key] = digest
+            digest["end"] = now
+            digest["count"] += 1
+            for box in new_boxes:
+                if not any(box_iou(seen, box) >= self.subject_iou for seen in digest["boxes"]):
+                    digest["boxes"].append(box)
+
+            best_conf = max((conf for _, conf in detections), default=0.0)
+            if best_conf > digest["best_conf"]:
+                digest["best_conf"] = best_conf
+                digest["best_frame"] = frame.copy()
+            return "queued"
+
+    def _flush_worker(self):
+        while self.running:
+            try:
+                self.flush()
+            except Exception as e:
+                logger.error(f"Alert aggregator error: {str(e)}")
+            time.sleep(0.5)
+
+    def flush(self, force=False):
+        """Sends every digest whose window has closed (or all of them if force)."""
+        now = time.time()
+        ready = []
+        with self.lock:
+            for key, digest in list(self.pending.items()):
+                if force or now - digest["start"] >= self.window:
+                    del self.pending[key]
+                    self.last_alert[key] = now
+                    self.subjects[key] = [s for s in self.subjects.get(key, []) if now - s[1] < self.subject_ttl]
+                    self.subjects[key].extend([box, now] for box in digest["boxes"])
+                    ready.append((key, digest, dict(self._stats_for(key))))
+
+        for (camera_id, zone), digest, stats in ready:
+            details = (
+                f"Camera: {camera_id} / Zone: {zone}\n"
+                f"{digest['count']} detection(s) of {len(digest['boxes'])} new subject(s) "
+                f"between {time.ctime(digest['start'])} and {time.ctime(digest['end'])}\n"
+                f"Best confidence: {digest['best_conf']:.2f}\n"
+                f"Suppressed so far: {stats['suppressed_cooldown']} during cooldown, "
+                f"{stats['suppressed_subject']} for already reported subjects"
+            )
+            subject = f"SECURITY ALERT: Suspicious Activity on {camera_id} ({zone})"
+            sent, _ = self.notifier.send_alert(digest["best_frame"], details, subject=subject)
+            with self.lock:
+                self._stats_for((camera_id, zone))["alerts_sent" if sent else "alerts_failed"] += 1
+
+    def get_stats(self):
+        with self.lock:
+            return [dict(camera=camera_id, zone=zone, pending=(camera_id, zone) in self.pending, **counts)
+                    for (camera_id, zone), counts in self.stats.items()]
+
+    def stop(self):
+        self.running = False
+        self.thread.join()
+        self.flush(force=True)
+
+def point_in_polygon(x, y, polygon):
+    """Ray-casting test for a point against a list of (x, y) vertices."""
+    inside = False
+    j = len(polygon) - 1
+    for i in range(len(polygon)):
+        xi, yi = polygon[i]
+        xj, yj = polygon[j]
+        if (yi > y) != (yj > y) and x < (xj - xi) * (y - yi) / (yj - yi) + xi:
+            inside = not inside
+        j = i
+    return inside
+
+def _parse_zone(shape):
+    """Returns a zone shape as a polygon [(x, y), ...], or None if it is malformed."""
+    number = lambda v: isinstance(v, (int, float)) and not isinstance(v, bool)
+    if not isinstance(shape, list):
+        return None
+    if len(shape) == 4 and all(number(v) for v in shape):
+        x1, y1, x2, y2 = shape
+        return [(x1, y1), (x2, y1), (x2, y2), (x1, y2)]
+    if len(shape) >= 3 and all(isinstance(p, list) and len(p) == 2 and all(number(v) for v in p) for p in shape):
+        return [tuple(point) for point in shape]
+    return None
+
+def load_zones(path="zones.json"):
+    """Reads per-camera zones: {camera_id: {zone_name: shape}}.
+
+    A shape is a rectangle [x1, y1, x2, y2] or a polygon [[x, y], ...] with at
+    least 3 points, in coordinates normalized to 0-1 so they survive resolution
+    changes. Rectangles are converted to polygons. Missing file means no zones;
+    malformed entries are logged and skipped.
+    """
+    if not os.path.exists(path):
+        return {}
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            config = json.load(f)
+    except Exception as e:
+        logger.error(f"Failed to load zones from {path}: {e}")
+        return {}
+    if not isinstance(config, dict):
+        logger.error(f"Failed to load zones from {path}: expected an object of cameras")
+        return {}
+
+    zones = {}
+    for camera_id, camera_zones in config.items():
+        if not isinstance(camera_zones, dict):
+            logger.error(f"Skipping zones for camera {camera_id}: expected an object of zones")
+            continue
+        zones[camera_id] = {}
+        for name, shape in camera_zones.items():
+            polygon = _parse_zone(shape)
+            if polygon is None:
+                logger.error(f"Skipping zone {name} of camera {camera_id}: not a rectangle or polygon")
+                continue
+            zones[camera_id][name] = polygon
+    return zones
+
 class SecuritySystem:
-    def __init__(self, device):
+    def __init__(self, device, zones_path="zones.json"):
         self.device = device
         self.model = None
         # Load YOLO model
@@ -84,38 +280,69 @@ class SecuritySystem:
             logger.error(f"Failed to load YOLO: {e}")
 
         self.email_notifier = EmailNotifier()
+        self.alert_aggregator = AlertAggregator(self.email_notifier)
+        self.zones = load_zones(zones_path)
         self.active = False
         self.current_state = "Normal"
         self.autopilot_active = False # Default: Monitoring ON, Alerts OFF
 
-    def process_frame(self, frame):
-        if not self.model: 
-            return frame, False, ""
+    def stop(self):
+        self.alert_aggregator.stop()
 
-        # Run inference
+    def zone_for(self, camera_id, box, frame_shape):
+        """Names the zone containing a box's bottom-centre (where the person stands)."""
+        height, width = frame_shape[:2]
+        x = (box[0] + box[2]) / 2 / width
+        y = box[3] / height
+        for name, polygon in self.zones.get(camera_id, {}).items():
+            if point_in_polygon(x, y, polygon):
+                return name
+        return "default"
+
+    def _draw_zones(self, frame, camera_id):
+        height, width = frame.shape[:2]
+        for name, polygon in self.zones.get(camera_id, {}).items():
+            points = np.array([[int(x * width), int(y * height)] for x, y in polygon], dtype=np.int32)
+            cv2.polylines(frame, [points], True, (0, 200, 255), 2)
+            cv2.putText(frame, name, tuple(points[0]), cv2.FONT_HERSHEY_SIMPLEX, 0.6, (0, 200, 255), 2)
+
+    def detect_persons(self, frame):
+        """Runs YOLO on a frame. Returns (results, [(box, confidence), ...]) for confident persons."""
         results = self.model(frame, verbose=False)
-        annotated_frame = results[0].plot()
-        
-        person_detected = False
-        detection_info = ""
+        detections = []
 
         # Check for 'person' class (id 0)
-        num_persons = 0
         for r in results:
             for box in r.boxes:
                 cls_id = int(box.cls[0])
                 if self.model.names[cls_id] == 'person':
                     conf = float(box.conf[0])
                     if conf > 0.5:
-                        num_persons += 1
-                        person_detected = True
-                        detection_info = f"INTRUDER DETECTED ({conf:.2f})"
+                        detections.append((box.xyxy[0].tolist(), conf))
+        return results, detections
+
+    def process_frame(self, frame, camera_id="default"):
+        if not self.model: 
+            return frame, False, ""
+
+        # Run inference
+        results, detections = self.detect_persons(frame)
+        annotated_frame = results[0].plot()
+        self._draw_zones(annotated_frame, camera_id)
+        
+        person_detected = bool(detections)
+        detection_info = f"INTRUDER DETECTED ({detections[-1][1]:.2f})" if detections else ""
         
         if person_detected:
             self.current_state = "Suspicious Activity Detected"
             # Trigger alert logic ONLY if Auto Pilot is active
             if self.autopilot_active:
-                self.email_notifier.send_alert(frame, detection_info)
+                # Each zone has its own cooldown, so group detections by zone
+                by_zone = {}
+                for box, conf in detections:
+                    by_zone.setdefault(self.zone_for(camera_id, box, frame.shape), []).append((box, conf))
+                for zone, zone_detections in by_zone.items():
+                    self.alert_aggregator.submit(frame, zone_detections, camera_id=camera_id, zone=zone)
             else:
                 print("Suspicious Activity Detected but Auto Pilot is OFF. Email skipped.")
         else:
@@ -123,11 +350,233 @@ class SecuritySystem:
         
         return annotated_frame, person_detected, detection_info
 
+def lock_directory(directory):
+    """Takes an exclusive lock on `directory` for this process.
+
+    Returns the open lock file (keep it open to hold the lock), or None if
+    another process holds it. The OS releases the lock when the process exits.
+    """
+    os.makedirs(directory, exist_ok=True)
+    lock_file = open(os.path.join(directory, ".lock"), "a+")
+    try:
+        if fcntl is not None:
+            fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+        else:
+            lock_file.seek(0)
+            msvcrt.locking(lock_file.fileno(), msvcrt.LK_NBLCK, 1)
+    except OSError:
+        lock_file.close()
+        return None
+    return lock_file
+
+class CaptionArchive:
+    """Persists captions and compact embeddings for sampled frames.
+
+    Embeddings live in memory-mapped float16 .npy files (one row per entry,
+    L2-normalized), and caption metadata in an append-only index.jsonl, so
+    search is a single matrix-vector product over the mapped rows.
+
+    Once `max_entries` is reached the oldest quarter is dropped, which bounds
+    disk use (100k entries is about 55 hours at one entry per 2 seconds).
+    Entry ids keep increasing across compactions.
+
+    Only one process may write an archive: the directory is locked for the
+    archive's lifetime (pass `lock_file` if the caller already holds it).
+    """
+    SEARCH_CHUNK = 8192  # Rows scored per lock acquisition (32 MB of float32 at 1024 dims)
+
+    def __init__(self, directory, image_dim, text_dim, initial_capacity=1024, max_entries=100000, lock_file=None):
+        self.directory = directory
+        self.image_dim = image_dim
+        self.text_dim = text_dim
+        self.max_entries = max_entries
+        self.lock_file = lock_file or lock_directory(directory)
+        if self.lock_file is None:
+            raise RuntimeError(f"Caption archive in {directory} is in use by another process")
+
+        self.lock = Lock()
+        self.generation = 0  # Bumped by every compaction, which shifts rows
+        self.index_path = os.path.join(directory, "index.jsonl")
+        self.entries = []
+        if os.path.exists(self.index_path):
+            with open(self.index_path, "r", encoding="utf-8") as f:
+                self.entries = [json.loads(line) for line in f if line.strip()]
+
+        capacity = max(initial_capacity, len(self.entries))
+        arrays = [("image_embeddings", image_dim, np.float16),
+                  ("text_embeddings", text_dim, np.float16),
+                  ("timestamps", None, np.float64)]
+        compatible = all(self._is_compatible(name + ".npy", len(self.entries), dim, dtype)
+                         for name, dim, dtype in arrays)
+        if not compatible:
+            # Rows no longer line up with index.jsonl, so start the archive over
+            logger.warning(f"Caption archive in {directory} is incompatible with this model, resetting it")
+            self.entries = []
+            open(self.index_path, "w").close()
+        for name, dim, dtype in arrays:
+            path = os.path.join(directory, name + ".npy")
+            if compatible and os.path.exists(path):
+                array = np.lib.format.open_memmap(path, mode="r+")
+            else:
+                shape = (capacity,) if dim is None else (capacity, dim)
+                array = np.lib.format.open_memmap(path, mode="w+", dtype=dtype, shape=shape)
+            setattr(self, name, array)
+
+    def _is_compatible(self, name, rows, dim, dtype):
+        """Whether an existing array file can back `rows` index entries."""
+        path = os.path.join(self.directory, name)
+        if not os.path.exists(path):
+            return rows == 0
+        array = np.lib.format.open_memmap(path, mode="r")
+        expected = () if dim is None else (dim,)
+        return array.shape[1:] == expected and array.dtype == dtype and array.shape[0] >= rows
+
+    def _grow_array(self, attr, name):
+        """Doubles the capacity of a memory-mapped array, preserving its rows."""
+        path = os.path.join(self.directory, name)
+        tmp_path = path + ".tmp"
+        array = getattr(self, attr)
+        setattr(self, attr, None)
+        grown = np.lib.format.open_memmap(tmp_path, mode="w+", dtype=array.dtype,
+                                          shape=(array.shape[0] * 2,) + array.shape[1:])
+        grown[:array.shape[0]] = array
+        grown.flush()
+        # Release both mappings before swapping files (required on Windows)
+        del grown, array
+        os.replace(tmp_path, path)
+        setattr(self, attr, np.lib.format.open_memmap(path, mode="r+"))
+
+    @staticmethod
+    def _normalize(vector):
+        vector = np.asarray(vector, dtype=np.float32).reshape(-1)
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm > 0 else vector
+
+    def _compact(self, keep):
+        """Drops all but the newest `keep` entries, shifting their rows to the front."""
+        drop = len(self.entries) - keep
+        for name in ["image_embeddings", "text_embeddings", "timestamps"]:
+            array = getattr(self, name)
+            array[:keep] = array[drop:drop + keep]
+            array.flush()
+        self.entries = self.entries[drop:]
+        self.generation += 1
+
+        tmp_path = self.index_path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            for entry in self.entries:
+                f.write(json.dumps(entry) + "\n")
+        os.replace(tmp_path, self.index_path)
+        logger.info(f"Caption archive compacted: dropped {drop} oldest entries")
+
+    def _row(self, entry_id):
+        """Row of an entry id, or None if it was never added or has been compacted away."""
+        if not self.entries:
+            return None
+        row = entry_id - self.entries[0]["id"]
+        return row if 0 <= row < len(self.entries) else None
+
+    def add(self, caption, image_embedding, text_embedding, timestamp=None, source="webcam"):
+        timestamp = time.time() if timestamp is None else timestamp
+        with self.lock:
+            if len(self.entries) >= self.max_entries:
+                self._compact(self.max_entries * 3 // 4)
+            entry_id = self.entries[-1]["id"] + 1 if self.entries else 0
+            row = len(self.entries)
+            if row >= len(self.timestamps):
+                self._grow_array("image_embeddings", "image_embeddings.npy")
+                self._grow_array("text_embeddings", "text_embeddings.npy")
+                self._grow_array("timestamps", "timestamps.npy")
+
+            self.image_embeddings[row] = self._normalize(image_embedding)
+            self.text_embeddings[row] = self._normalize(text_embedding)
+            self.timestamps[row] = timestamp
+
+            entry = {"id": entry_id, "timestamp": timestamp, "caption": caption, "source": source}
+            with open(self.index_path, "a", encoding="utf-8") as f:
+                f.write(json.dumps(entry) + "\n")
+            self.entries.append(entry)
+        return entry_id
+
+    def flush(self):
+        with self.lock:
+            self.image_embeddings.flush()
+            self.text_embeddings.flush()
+            self.timestamps.flush()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def _search(self, name, query, top_k, start, end, exclude_id=None):
+        """Top-k entries by cosine similarity against one embedding array.
+
+        Rows are scored in chunks of SEARCH_CHUNK, taking the lock per chunk
+        only, so a long search neither blocks add() nor copies the whole array.
+        A compaction in the middle shifts rows, so the search starts over.
+        """
+        query = self._normalize(query)
+        while True:
+            with self.lock:
+                count = len(self.entries)
+                generation = self.generation
+            if count == 0:
+                return []
+
+            scores = np.full(count, -np.inf, dtype=np.float32)
+            for chunk_start in range(0, count, self.SEARCH_CHUNK):
+                chunk_end = min(count, chunk_start + self.SEARCH_CHUNK)
+                with self.lock:
+                    if self.generation != generation:
+                        break
+                    rows = getattr(self, name)[chunk_start:chunk_end].astype(np.float32)
+                    times = np.array(self.timestamps[chunk_start:chunk_end])
+                chunk_scores = rows @ query
+                if start is not None:
+                    chunk_scores[times < start] = -np.inf
+                if end is not None:
+                    chunk_scores[times > end] = -np.inf
+                scores[chunk_start:chunk_end] = chunk_scores
+            else:
+                candidates = np.flatnonzero(np.isfinite(scores))
+                # One extra, in case the excluded entry is among the best
+                k = min(top_k + (exclude_id is not None), len(candidates))
+                if k == 0:
+                    return []
+                candidate_scores = scores[candidates]
+                best = np.argpartition(-candidate_scores, k - 1)[:k]
+                best = best[np.argsort(-candidate_scores[best])]
+                with self.lock:
+                    if self.generation != generation:
+                        continue
+                    results = [dict(self.entries[candidates[i]], score=float(candidate_scores[i])) for i in best]
+                results = [r for r in results if r["id"] != exclude_id]
+                return results[:top_k]
+
+    def search_text(self, query_embedding, top_k=10, start=None, end=None):
+        """Ranks archived captions against an embedded text query."""
+        return self._search("text_embeddings", query_embedding, top_k, start, end)
+
+    def search_similar(self, entry_id, top_k=10, start=None, end=None):
+        """Ranks archived frames by visual similarity to an existing entry."""
+        with self.lock:
+            row = self._row(entry_id)
+            if row is None:
+                return []
+            query = np.array(self.image_embeddings[row], dtype=np.float32)
+        return self._search("image_embeddings", query, top_k, start, end, exclude_id=entry_id)
+
 class CaptionGenerator:
-    def __init__(self, processor, model, device):
+    # Filler words carry no meaning in a mean-pooled caption embedding.
+    # Spatial words ("near", "on", "by", ...) are kept: queries depend on them.
+    STOPWORDS = {"a", "an", "the", "of", "and", "is", "are", "there", "it", "its", "this", "that"}
+
+    def __init__(self, processor, model, device, archive=None, archive_interval=2.0):
         self.processor = processor
         self.model = model
         self.device = device
+        self.archive = archive
+        self.archive_interval = archive_interval
+        self.last_archive_time = 0
         self.current_caption = f"Initializing caption... ({device.upper()})"
         self.caption_queue = Queue(maxsize=1)
         self.lock = Lock()
@@ -141,40 +590,70 @@ class CaptionGenerator:
             try:
                 if not self.caption_queue.empty():
                     frame = self.caption_queue.get()
-                    caption = self._generate_caption(frame)
+                    caption, image_embedding = self._generate_caption(frame)
                     print(f"DEBUG: Generated caption: {caption}")
                     with self.lock:
                         self.current_caption = caption
+                    self._archive_caption(caption, image_embedding)
             except Exception as e:
                 logger.error(f"Caption worker error: {str(e)}")
             time.sleep(0.1)  # Prevent busy waiting
 
     def _generate_caption(self, image):
+        """Returns (caption, pooled image embedding) from a single vision-encoder pass."""
         try:
-            # Resize to 640x480 (or any other size)
-            image_resized = cv2.resize(image, (640, 480))
-
-            # Convert to RGB
-            rgb_image = cv2.cvtColor(image_resized, cv2.COLOR_BGR2RGB)
-            pil_image = Image.fromarray(rgb_image)
-
-            # Process the image for captioning
-            inputs = self.processor(images=pil_image, return_tensors="pt")
-            inputs = {name: tensor.to(self.device) for name, tensor in inputs.items()}
+            # Resize to 640x480, convert to RGB and process for captioning
+            inputs = self._prepare_inputs(image)
 
-            with torch.no_grad():
-                outputs = self.model.generate(
-                    **inputs,
-                    max_length=30,
-                    num_beams=5,
-                    num_return_sequences=1
-                )
+            # generate() runs the vision encoder once; keep its pooled output for the archive
+            pooled = []
+            hook = self.model.vision_model.register_forward_hook(
+                lambda module, args, output: pooled.append(output.pooler_output))
+            try:
+                with torch.no_grad():
+                    outputs = self.model.generate(
+                        **inputs,
+                        max_length=30,
+                        num_beams=5,
+                        num_return_sequences=1
+                    )
+            finally:
+                hook.remove()
 
             caption = self.processor.batch_decode(outputs, skip_special_tokens=True)[0].strip()
-            return f"{caption}"
+            embedding = pooled[0][0].float().cpu().numpy() if pooled else None
+            return f"{caption}", embedding
         except Exception as e:
             logger.error(f"Caption generation error: {str(e)}")
-            return f"Error: Caption generation failed"
+            return f"Error: Caption generation failed", None
+
+    def _prepare_inputs(self, image):
+        rgb_image = cv2.cvtColor(cv2.resize(image, (640, 480)), cv2.COLOR_BGR2RGB)
+        inputs = self.processor(images=Image.fromarray(rgb_image), return_tensors="pt")
+        return {name: tensor.to(self.device) for name, tensor in inputs.items()}
+
+    def embed_text(self, text):
+        """Mean-pooled BLIP word embeddings for a caption or search query."""
+        words = [w for w in text.lower().split() if w not in self.STOPWORDS] or text.lower().split()
+        token_ids = self.processor.tokenizer(" ".join(words), add_special_tokens=False,
+                                             return_tensors="pt")["input_ids"].to(self.device)
+        embeddings = self.model.text_decoder.get_input_embeddings()
+        with torch.no_grad():
+            if token_ids.shape[1] == 0:
+                return np.zeros(embeddings.embedding_dim, dtype=np.float32)
+            return embeddings(token_ids)[0].mean(dim=0).float().cpu().numpy()
+
+    def _archive_caption(self, caption, image_embedding):
+        if not self.archive or image_embedding is None:
+            return
+        now = time.time()
+        if now - self.last_archive_time < self.archive_interval:
+            return
+        try:
+            self.archive.add(caption, image_embedding, self.embed_text(caption), timestamp=now)
+            self.last_archive_time = now
+        except Exception as e:
+            logger.error(f"Caption archive error: {str(e)}")
 
     def update_frame(self, frame):
         if self.caption_queue.empty():
@@ -190,6 +669,183 @@ class CaptionGenerator:
     def stop(self):
         self.running = False
         self.thread.join()
+        if self.archive:
+            self.archive.flush()
+
+class FrameBuffer:
+    """Keeps the latest raw and annotated frame per camera.
+
+    Entries are bus Messages, so a frame is only decoded when someone asks
+    for it (e.g. a snapshot) and readers never touch the camera. Frames older
+    than `max_age` seconds are treated as missing, so a stalled source never
+    yields a stale snapshot.
+    """
+    def __init__(self, max_age=5.0):
+        self.lock = Lock()
+        self.max_age = max_age
+        self.raw_frames = {}        # camera_id -> (message, received time)
+        self.annotated_frames = {}  # camera_id -> (message, received time)
+
+    def update_raw(self, camera_id, message):
+        with self.lock:
+            self.raw_frames[camera_id] = (message, time.time())
+
+    def update_annotated(self, camera_id, message):
+        with self.lock:
+            self.annotated_frames[camera_id] = (message, time.time())
+
+    def _fresh_frame(self, entry):
+        if entry is None or time.time() - entry[1] > self.max_age:
+            return None
+        return entry[0].frame
+
+    def get_raw(self, camera_id):
+        with self.lock:
+            entry = self.raw_frames.get(camera_id)
+        return self._fresh_frame(entry)
+
+    def get_annotated(self, camera_id):
+        with self.lock:
+            entry = self.annotated_frames.get(camera_id)
+        return self._fresh_frame(entry)
+
+SNAPSHOT_NAME = re.compile(r"^snapshot_(\d+)_(\d{9})_(raw|annotated)\.jpg$")
+
+class SnapshotManager:
+    """Writes snapshots and their thumbnails into a managed directory.
+
+    File names embed a millisecond timestamp plus the process id and a
+    sequence number, so they never collide (even across web workers) and sort
+    chronologically. Thumbnails are generated once and kept in a small
+    in-memory LRU cache.
+    """
+    def __init__(self, directory="snapshots", thumb_width=160, cache_size=64):
+        self.directory = directory
+        self.thumb_dir = os.path.join(directory, "thumbs")
+        self.thumb_width = thumb_width
+        self.cache_size = cache_size
+        os.makedirs(self.thumb_dir, exist_ok=True)
+
+        self.lock = Lock()
+        self.sequence = itertools.count()
+        self.thumb_cache = OrderedDict()
+        self.index = []
+        self.known = set()
+        self.dir_mtime = None
+        self._refresh()
+
+    def _refresh(self):
+        """Rescans the directory if it changed, e.g. after another worker saved a snapshot."""
+        mtime = os.stat(self.directory).st_mtime_ns
+        if mtime == self.dir_mtime:
+            return
+        # Oldest first; names sort chronologically
+        index = sorted(
+            name for name in os.listdir(self.directory) if SNAPSHOT_NAME.match(name)
+        )
+        with self.lock:
+            self.index = index
+            self.known = set(index)
+            self.dir_mtime = mtime
+
+    def _make_filename(self, kind):
+        seq = next(self.sequence) % 10000
+        return f"snapshot_{int(time.time() * 1000)}_{os.getpid() % 100000:05d}{seq:04d}_{kind}.jpg"
+
+    def _make_thumbnail(self, frame):
+        height, width = frame.shape[:2]
+        thumb_height = max(1, int(height * self.thumb_width / width))
+        thumb = cv2.resize(frame, (self.thumb_width, thumb_height), interpolation=cv2.INTER_AREA)
+        success, encoded = cv2.imencode('.jpg', thumb, [cv2.IMWRITE_JPEG_QUALITY, 70])
+        return encoded.tobytes() if success else None
+
+    def _cache_thumbnail(self, filename, data):
+        with self.lock:
+            self.thumb_cache[filename] = data
+            self.thumb_cache.move_to_end(filename)
+            while len(self.thumb_cache) > self.cache_size:
+                self.thumb_cache.popitem(last=False)
+
+    def save(self, frame, kind="raw"):
+        """Encodes and writes a frame plus its thumbnail. Blocking; run off the event loop."""
+        success, encoded = cv2.imencode('.jpg', frame)
+        if not success:
+            return None
+
+        # If the index is current now, this write is the only change to the
+        # directory, so record the new mtime instead of forcing a rescan
+        with self.lock:
+            up_to_date = os.stat(self.directory).st_mtime_ns == self.dir_mtime
+
+        filename = self._make_filename(kind)
+        with open(os.path.join(self.directory, filename), "wb") as f:
+            f.write(encoded.tobytes())
+
+        thumb = self._make_thumbnail(frame)
+        if thumb is not None:
+            with open(os.path.join(self.thumb_dir, filename), "wb") as f:
+                f.write(thumb)
+            self._cache_thumbnail(filename, thumb)
+
+        with self.lock:
+            self.index.append(filename)
+            self.known.add(filename)
+            if up_to_date:
+                self.dir_mtime = os.stat(self.directory).st_mtime_ns
+        return filename
+
+    @staticmethod
+    def describe(filename):
+        """Returns (timestamp_seconds, kind) parsed from a snapshot file name."""
+        match = SNAPSHOT_NAME.match(filename)
+        return int(match.group(1)) / 1000, match.group(3)
+
+    def exists(self, filename):
+        self._refresh()
+        with self.lock:
+            return filename in self.known
+
+    def path(self, filename):
+        return os.path.join(self.directory, filename)
+
+    def get_thumbnail(self, filename):
+        """Returns thumbnail JPEG bytes, generating and persisting it on first use."""
+        if not self.exists(filename):
+            return None
+
+        with self.lock:
+            data = self.thumb_cache.get(filename)
+            if data is not None:
+                self.thumb_cache.move_to_end(filename)
+                return data
+
+        thumb_path = os.path.join(self.thumb_dir, filename)
+        if os.path.exists(thumb_path):
+            with open(thumb_path, "rb") as f:
+                data = f.read()
+        else:
+            frame = cv2.imread(self.path(filename))
+            if frame is None:
+                return None
+            data = self._make_thumbnail(frame)
+            if data is None:
+                return None
+            with open(thumb_path, "wb") as f:
+                f.write(data)
+
+        self._cache_thumbnail(filename, data)
+        return data
+
+    def list(self, offset=0, limit=20):
+        """Returns (total, filenames) for one page, newest first."""
+        self._refresh()
+        with self.lock:
+            total = len(self.index)
+            end = max(0, total - offset)
+            start = max(0, end - limit)
+            page = self.index[start:end]
+        page.reverse()
+        return total, page
 
 def get_gpu_usage():
     """Get the GPU memory usage and approximate utilization"""
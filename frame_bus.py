@@ -0,0 +1,252 @@
+import cv2
+import json
+import logging
+import numpy as np
+from threading import Lock, Condition
+from collections import OrderedDict, deque
+
+try:
+    import zmq  # Optional: only needed to connect separate processes/hosts
+except ImportError:
+    zmq = None
+
+logger = logging.getLogger(__name__)
+
+# Messages on these topics are retained (last value per topic) and replayed to
+# every new subscriber, so a process that joins late still sees shared state
+RETAINED_PREFIX = "cluster/state/"
+
+class Message:
+    """A bus message: a topic, a JSON-serializable header and an optional frame.
+
+    The frame is carried as an array in-process and as JPEG bytes over sockets;
+    each form is produced lazily, so a web worker that only relays JPEGs never
+    decodes them. Receivers must not modify the frame in place.
+    """
+    def __init__(self, topic, header=None, frame=None, jpeg=None):
+        self.topic = topic
+        self.header = header or {}
+        self._frame = frame
+        self._jpeg = jpeg
+
+    @property
+    def frame(self):
+        if self._frame is None and self._jpeg:
+            self._frame = cv2.imdecode(np.frombuffer(self._jpeg, np.uint8), cv2.IMREAD_COLOR)
+        return self._frame
+
+    @property
+    def jpeg(self):
+        if self._jpeg is None and self._frame is not None:
+            success, encoded = cv2.imencode('.jpg', self._frame)
+            self._jpeg = encoded.tobytes() if success else b""
+        return self._jpeg
+
+class _PendingMessages:
+    """Receive buffer shared by both bus types.
+
+    With conflate=True only the newest message per topic is kept, so slow
+    consumers always see the latest frame of every camera and never a backlog.
+    """
+    def __init__(self, conflate, max_pending=1000):
+        self.conflate = conflate
+        self.max_pending = max_pending
+        self.condition = Condition()
+        self.latest = OrderedDict()
+        self.queue = deque()
+
+    def put(self, message):
+        with self.condition:
+            if self.conflate:
+                self.latest.pop(message.topic, None)
+                self.latest[message.topic] = message
+            else:
+                if len(self.queue) >= self.max_pending:
+                    logger.warning(f"Dropping message on {message.topic}: subscriber is not keeping up")
+                    self.queue.popleft()
+                self.queue.append(message)
+            self.condition.notify()
+
+    def get_nowait(self):
+        with self.condition:
+            if self.latest:
+                return self.latest.popitem(last=False)[1]
+            if self.queue:
+                return self.queue.popleft()
+            return None
+
+    def get(self, timeout=None):
+        with self.condition:
+            self.condition.wait_for(lambda: self.latest or self.queue, timeout=timeout)
+        return self.get_nowait()
+
+class InProcessSubscription:
+    def __init__(self, bus, prefix, conflate):
+        self.bus = bus
+        self.prefix = prefix
+        self.pending = _PendingMessages(conflate)
+
+    def recv(self, timeout=None):
+        """Returns the next Message, or None on timeout."""
+        return self.pending.get(timeout)
+
+    def close(self):
+        self.bus._unsubscribe(self)
+
+class InProcessBus:
+    """Topic-prefix publish/subscribe between threads of one process."""
+    def __init__(self):
+        self.lock = Lock()
+        self.subscriptions = []
+        self.retained = {}
+
+    def publish(self, topic, header=None, frame=None, jpeg=None):
+        message = Message(topic, header, frame=frame, jpeg=jpeg)
+        with self.lock:
+            if topic.startswith(RETAINED_PREFIX):
+                self.retained[topic] = message
+            targets = [s for s in self.subscriptions if topic.startswith(s.prefix)]
+        for subscription in targets:
+            subscription.pending.put(message)
+
+    def subscribe(self, prefix, conflate=True):
+        subscription = InProcessSubscription(self, prefix, conflate)
+        with self.lock:
+            self.subscriptions.append(subscription)
+            for topic, message in self.retained.items():
+                if topic.startswith(prefix):
+                    subscription.pending.put(message)
+        return subscription
+
+    def _unsubscribe(self, subscription):
+        with self.lock:
+            if subscription in self.subscriptions:
+                self.subscriptions.remove(subscription)
+
+    def close(self):
+        with self.lock:
+            self.subscriptions = []
+
+def broker_endpoints(url):
+    """Maps a bus URL to the broker's (publisher-facing, subscriber-facing) endpoints.
+
+    ipc:///tmp/museumguard -> ipc:///tmp/museumguard.in, ipc:///tmp/museumguard.out
+    tcp://127.0.0.1:5555   -> tcp://127.0.0.1:5555,      tcp://127.0.0.1:5556
+    """
+    if url.startswith("ipc://"):
+        return url + ".in", url + ".out"
+    if url.startswith("tcp://"):
+        host, port = url.rsplit(":", 1)
+        return f"{host}:{port}", f"{host}:{int(port) + 1}"
+    raise ValueError(f"Unsupported bus URL: {url}")
+
+class ZmqSubscription:
+    def __init__(self, context, endpoint, prefix, conflate):
+        self.prefix = prefix
+        self.socket = context.socket(zmq.SUB)
+        # Keep the socket queue short for frames so stale ones are dropped early
+        self.socket.setsockopt(zmq.RCVHWM, 10 if conflate else 1000)
+        self.socket.setsockopt(zmq.LINGER, 0)
+        self.socket.setsockopt(zmq.SUBSCRIBE, prefix.encode())
+        self.socket.connect(endpoint)
+        self.pending = _PendingMessages(conflate)
+
+    def _drain(self):
+        while True:
+            try:
+                topic, header, payload = self.socket.recv_multipart(zmq.NOBLOCK)
+            except zmq.Again:
+                return
+            self.pending.put(Message(topic.decode(), json.loads(header), jpeg=payload or None))
+
+    def recv(self, timeout=None):
+        """Returns the next Message, or None on timeout."""
+        self._drain()
+        message = self.pending.get_nowait()
+        if message is not None:
+            return message
+        if self.socket.poll(None if timeout is None else int(timeout * 1000)):
+            self._drain()
+        return self.pending.get_nowait()
+
+    def close(self):
+        self.socket.close()
+
+class ZmqBus:
+    """Topic-prefix publish/subscribe between processes through a ZeroMQ broker.
+
+    Every process connects to the broker started with run_broker(), so any
+    number of capture, inference and web processes can join or leave.
+    """
+    def __init__(self, url):
+        if zmq is None:
+            raise ImportError("pyzmq is not installed (pip install pyzmq)")
+        self.url = url
+        self.frontend, self.backend = broker_endpoints(url)
+        self.context = zmq.Context.instance()
+        self.lock = Lock()  # ZeroMQ sockets are not thread-safe
+        self.publisher = self.context.socket(zmq.PUB)
+        self.publisher.setsockopt(zmq.SNDHWM, 100)
+        self.publisher.setsockopt(zmq.LINGER, 0)
+        self.publisher.connect(self.frontend)
+
+    def publish(self, topic, header=None, frame=None, jpeg=None):
+        message = Message(topic, header, frame=frame, jpeg=jpeg)
+        parts = [topic.encode(), json.dumps(message.header).encode(), message.jpeg or b""]
+        with self.lock:
+            self.publisher.send_multipart(parts)
+
+    def subscribe(self, prefix, conflate=True):
+        return ZmqSubscription(self.context, self.backend, prefix, conflate)
+
+    def close(self):
+        with self.lock:
+            self.publisher.close()
+
+def run_broker(url):
+    """Forwards every published message to every subscriber. Blocks forever.
+
+    Like zmq.proxy, but it also keeps the last message of each retained topic
+    and replays it whenever a matching subscription arrives.
+    The broker does no authentication: only bind it to ipc:// or to a trusted network.
+    """
+    if zmq is None:
+        raise ImportError("pyzmq is not installed (pip install pyzmq)")
+    frontend, backend = broker_endpoints(url)
+    context = zmq.Context.instance()
+    xsub = context.socket(zmq.XSUB)
+    xsub.bind(frontend)
+    xpub = context.socket(zmq.XPUB)
+    # Report every subscription, not just the first per prefix, so each
+    # newcomer triggers a replay of retained state
+    xpub.setsockopt(zmq.XPUB_VERBOSE, 1)
+    xpub.bind(backend)
+    logger.info(f"Bus broker running: publishers -> {frontend}, subscribers -> {backend}")
+
+    retained = {}
+    retained_prefix = RETAINED_PREFIX.encode()
+    poller = zmq.Poller()
+    poller.register(xsub, zmq.POLLIN)
+    poller.register(xpub, zmq.POLLIN)
+    while True:
+        events = dict(poller.poll())
+        if xsub in events:
+            parts = xsub.recv_multipart()
+            if parts[0].startswith(retained_prefix):
+                retained[parts[0]] = parts
+            xpub.send_multipart(parts)
+        if xpub in events:
+            event = xpub.recv()
+            xsub.send(event)
+            # Subscription events are b"\x01" + prefix
+            if event[:1] == b"\x01":
+                prefix = event[1:]
+                for topic, parts in retained.items():
+                    if topic.startswith(prefix):
+                        xpub.send_multipart(parts)
+
+def create_bus(url="inproc"):
+    """Returns an InProcessBus for 'inproc', otherwise a ZmqBus for ipc:// or tcp:// URLs."""
+    if not url or url == "inproc":
+        return InProcessBus()
+    return ZmqBus(url)
@@ -0,0 +1,605 @@
+"""Capture, inference and serving roles connected by a frame/result bus.
+
+Topics:
+    frames/<camera_id>        raw frames from a capture node
+    results/<camera_id>       annotated frames plus detection state from inference
+    control                   requests from web workers (JSON header only)
+    replies/<client_id>       answers to requests that carry a reply_to
+    cluster/status/<node_id>  node heartbeats (role, owned cameras, captioning, caption)
+    cluster/state/<key>       shared settings (autopilot, source); retained by the bus
+    cluster/demand/<client>   which streams a web worker is currently serving
+
+Run every role in separate processes on one box with:
+    python nodes.py broker --bus ipc:///tmp/museumguard
+    python nodes.py capture --bus ipc:///tmp/museumguard --camera-id webcam --source auto
+    python nodes.py capture --bus ipc:///tmp/museumguard --camera-id video
+    python nodes.py inference --bus ipc:///tmp/museumguard
+    MUSEUMGUARD_BUS=ipc:///tmp/museumguard uvicorn app:app --workers 4
+
+Recorded evidence can be scanned offline, without a bus, as fast as it decodes
+(keyframes only with PyAV, unless --all-frames is given):
+    python nodes.py analyze --file evidence.mp4 --camera-id video
+
+Inference nodes split cameras between themselves automatically (rendezvous
+hashing over live nodes), or explicitly with --cameras. Without --always-on,
+capture and inference only work while a web worker serves a stream or the
+autopilot is on, like the single-process app did. An uploaded video (camera
+'video') is only played and analyzed while it is the selected source.
+A node only captions if it can lock its --archive-dir, so a second node on
+the same box runs detection only; check_cluster.py starts such a cluster.
+
+The bus has no authentication or encryption: keep it on ipc:// or a trusted
+network. SMTP credentials are read from each inference node's environment
+(MUSEUMGUARD_SMTP_*) and never sent over the bus. Uploaded videos are passed
+by path, so with capture nodes on other hosts MUSEUMGUARD_UPLOAD_DIR must be
+shared storage mounted at the same path everywhere.
+"""
+import cv2
+import os
+import time
+import uuid
+import zlib
+import argparse
+import logging
+from threading import Thread, Lock
+from frame_bus import create_bus, run_broker, RETAINED_PREFIX
+from video_decoder import open_video, iter_frames, PrefetchingDecoder
+
+logger = logging.getLogger(__name__)
+
+CONTROL_TOPIC = "control"
+CLUSTER_PREFIX = "cluster/"
+STATUS_PREFIX = "cluster/status/"
+STATE_PREFIX = RETAINED_PREFIX
+DEMAND_PREFIX = "cluster/demand/"
+
+DEFAULT_STATE = {"autopilot": False, "source": "webcam"}
+NODE_TIMEOUT = 3.0  # Seconds without a heartbeat before a node or viewer counts as gone
+
+def open_camera(source):
+    """Opens a webcam index, a video file (paced, looping), or 'auto' (camera 0, then 1)."""
+    if source == "auto":
+        for index in [0, 1]:
+            capture = cv2.VideoCapture(index)
+            if capture.isOpened():
+                return capture
+            print(f"Warning: Could not open camera {index}.")
+            capture.release()
+        print("Error: Could not open any camera.")
+        return None
+    if isinstance(source, int) or str(source).isdigit():
+        capture = cv2.VideoCapture(int(source))
+        return capture if capture.isOpened() else None
+    if os.path.exists(source):
+        return open_video(source)
+    return None
+
+def publish_state(bus, key, value):
+    """Sets a shared setting. The bus retains it, so nodes that start later pick it up."""
+    bus.publish(f"{STATE_PREFIX}{key}", {"value": value})
+
+class ClusterView:
+    """Follows cluster/ topics: node heartbeats, shared state and stream demand."""
+    def __init__(self, bus):
+        self.lock = Lock()
+        self.nodes = {}    # node_id -> (heartbeat, received time)
+        self.state = {}    # key -> value
+        self.demand = {}   # client_id -> (demand, received time)
+        self.subscription = bus.subscribe(CLUSTER_PREFIX, conflate=False)
+        self.running = True
+        self.thread = Thread(target=self._follow)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def _follow(self):
+        while self.running:
+            message = self.subscription.recv(timeout=0.5)
+            if message is None:
+                continue
+            now = time.time()
+            with self.lock:
+                if message.topic.startswith(STATUS_PREFIX):
+                    self.nodes[message.topic[len(STATUS_PREFIX):]] = (message.header, now)
+                elif message.topic.startswith(STATE_PREFIX):
+                    self.state[message.topic[len(STATE_PREFIX):]] = message.header.get("value")
+                elif message.topic.startswith(DEMAND_PREFIX):
+                    self.demand[message.topic[len(DEMAND_PREFIX):]] = (message.header, now)
+
+    def get_state(self, key):
+        with self.lock:
+            return self.state.get(key, DEFAULT_STATE.get(key))
+
+    def live_nodes(self, role):
+        """Returns {node_id: heartbeat} for nodes of a role seen recently."""
+        now = time.time()
+        with self.lock:
+            return {node_id: heartbeat for node_id, (heartbeat, seen) in self.nodes.items()
+                    if heartbeat.get("role") == role and now - seen < NODE_TIMEOUT}
+
+    def has_demand(self, kind):
+        """Whether anyone needs a stream kind ('caption', 'security' or 'any') right now.
+
+        An active autopilot counts as security demand: alerts must work unwatched.
+        """
+        if kind in ["security", "any"] and self.get_state("autopilot"):
+            return True
+        now = time.time()
+        with self.lock:
+            for demand, seen in self.demand.values():
+                if now - seen < NODE_TIMEOUT and (demand.get(kind) or (kind == "any" and any(demand.values()))):
+                    return True
+        return False
+
+    def stop(self):
+        self.running = False
+        self.thread.join()
+        self.subscription.close()
+
+class CaptureNode:
+    """Reads one camera or file and publishes its frames on frames/<camera_id>.
+
+    The source can be changed at runtime with an 'open_source' request, which
+    is how uploaded videos reach the capture process. A recorded file is only
+    played while its camera is the selected source (even with always_on), so
+    a looping upload never keeps detection and alerts running in the background.
+    With as_live=True a file stands in for a live camera (for testing without one).
+    """
+    def __init__(self, bus, camera_id, source=None, always_on=False, as_live=False):
+        self.bus = bus
+        self.camera_id = camera_id
+        self.always_on = always_on
+        self.as_live = as_live
+        self.node_id = f"capture-{camera_id}-{uuid.uuid4().hex[:8]}"
+        self.lock = Lock()
+        self.capture = open_camera(source) if source is not None else None
+        self.sequence = 0
+        self.running = True
+        self.cluster = ClusterView(bus)
+        self.control = bus.subscribe(CONTROL_TOPIC, conflate=False)
+        self.threads = [Thread(target=self._capture_worker), Thread(target=self._control_worker)]
+        for thread in self.threads:
+            thread.daemon = True
+            thread.start()
+
+    def _capture_worker(self):
+        while self.running:
+            with self.lock:
+                capture = self.capture
+            recorded = isinstance(capture, PrefetchingDecoder) and not self.as_live
+            active = self.always_on or self.cluster.has_demand("any")
+            if recorded and self.cluster.get_state("source") != self.camera_id:
+                active = False
+            if capture is None or not active:
+                time.sleep(0.2)
+                continue
+            try:
+                success, frame = capture.read()
+            except Exception as e:
+                logger.error(f"Capture error on {self.camera_id}: {str(e)}")
+                success, frame = False, None
+            if not success:
+                time.sleep(0.05)
+                continue
+            self.sequence += 1
+            self.bus.publish(f"frames/{self.camera_id}",
+                             {"camera_id": self.camera_id, "timestamp": time.time(), "seq": self.sequence,
+                              "recorded": recorded},
+                             frame=frame)
+
+    def _open_source(self, source):
+        capture = open_camera(source)
+        if capture is None:
+            logger.error(f"Could not open source {source} for {self.camera_id}")
+            return {"status": "error", "message": f"Capture node for '{self.camera_id}' could not open {source}"}
+        with self.lock:
+            old, self.capture = self.capture, capture
+        if old is not None:
+            old.release()
+        return {"status": "success"}
+
+    def _control_worker(self):
+        last_status = 0
+        while self.running:
+            message = self.control.recv(timeout=0.5)
+            header = message.header if message is not None else {}
+            if header.get("command") == "open_source" and header.get("camera_id") == self.camera_id:
+                reply = self._open_source(header.get("source"))
+                if header.get("reply_to"):
+                    self.bus.publish(header["reply_to"], {"request_id": header.get("request_id"),
+                                                          "node_id": self.node_id, "result": reply})
+            if time.time() - last_status >= 1.0:
+                self.bus.publish(f"{STATUS_PREFIX}{self.node_id}", {"role": "capture", "camera_id": self.camera_id})
+                last_status = time.time()
+
+    def stop(self):
+        self.running = False
+        for thread in self.threads:
+            thread.join()
+        self.control.close()
+        self.cluster.stop()
+        with self.lock:
+            if self.capture is not None:
+                self.capture.release()
+
+class InferenceNode:
+    """Runs the security pipeline (and optionally captioning) on bus frames.
+
+    Detection runs on every live camera this node owns, and results are
+    published per camera; which one the UI shows is the web worker's choice.
+    Recorded files are only analyzed while they are the selected source.
+    With `cameras` set the node owns exactly those. Otherwise cameras are
+    spread over all live auto-assigned nodes by rendezvous hashing, skipping
+    cameras that a live node claims explicitly, so no two nodes do the same work.
+    Captioning is spread the same way over the nodes that hold an archive.
+    """
+    def __init__(self, bus, security_system, caption_generator=None, cameras=None,
+                 caption_camera="webcam", always_on=False):
+        self.bus = bus
+        self.security_system = security_system
+        self.caption_generator = caption_generator
+        self.cameras = set(cameras) if cameras else None
+        self.caption_camera = caption_camera
+        self.always_on = always_on
+        self.node_id = f"inference-{uuid.uuid4().hex[:8]}"
+        self.running = True
+        self.cluster = ClusterView(bus)
+        self.frames = bus.subscribe("frames/", conflate=True)
+        self.control = bus.subscribe(CONTROL_TOPIC, conflate=False)
+        self.threads = [Thread(target=self._frame_worker), Thread(target=self._control_worker)]
+        for thread in self.threads:
+            thread.daemon = True
+            thread.start()
+
+    def owns(self, camera_id):
+        if self.cameras is not None:
+            return camera_id in self.cameras
+        auto_nodes = {self.node_id}
+        for node_id, heartbeat in self.cluster.live_nodes("inference").items():
+            if heartbeat.get("cameras") is None:
+                auto_nodes.add(node_id)
+            elif camera_id in heartbeat["cameras"] and node_id != self.node_id:
+                return False
+        owner = max(auto_nodes, key=lambda node_id: zlib.crc32(f"{node_id}/{camera_id}".encode()))
+        return owner == self.node_id
+
+    def captions(self):
+        """Whether this node is the one captioning caption_camera right now."""
+        if not self.caption_generator:
+            return False
+        nodes = {self.node_id}
+        nodes.update(node_id for node_id, heartbeat in self.cluster.live_nodes("inference").items()
+                     if heartbeat.get("captioning"))
+        owner = max(nodes, key=lambda node_id: zlib.crc32(f"{node_id}/caption/{self.caption_camera}".encode()))
+        return owner == self.node_id
+
+    def _frame_worker(self):
+        while self.running:
+            message = self.frames.recv(timeout=0.5)
+            if message is None:
+                continue
+            camera_id = message.header.get("camera_id")
+            try:
+                # Only decode webcam frames when the caption worker can take one
+                if (self.caption_generator and camera_id == self.caption_camera
+                        and (self.always_on or self.cluster.has_demand("caption"))
+                        and self.caption_generator.caption_queue.empty() and self.captions()):
+                    self.caption_generator.update_frame(message.frame)
+
+                # A recorded file is only analyzed while selected, so a looping
+                # upload never raises alerts in the background
+                selected = not message.header.get("recorded") or camera_id == self.cluster.get_state("source")
+                if (self.security_system and selected and self.owns(camera_id)
+                        and (self.always_on or self.cluster.has_demand("security"))):
+                    self.security_system.autopilot_active = bool(self.cluster.get_state("autopilot"))
+                    annotated_frame, detected, info = self.security_system.process_frame(
+                        message.frame, camera_id=camera_id)
+                    self.bus.publish(f"results/{camera_id}", {
+                        "camera_id": camera_id,
+                        "node_id": self.node_id,
+                        "timestamp": message.header.get("timestamp"),
+                        "detected": detected,
+                        "info": info,
+                        "state": self.security_system.current_state,
+                    }, frame=annotated_frame)
+            except Exception as e:
+                logger.error(f"Inference error on {camera_id}: {str(e)}")
+
+    def _publish_status(self):
+        status = {"role": "inference", "cameras": sorted(self.cameras) if self.cameras is not None else None,
+                  "captioning": self.caption_generator is not None}
+        if self.captions():
+            status["caption"] = self.caption_generator.get_caption()
+        self.bus.publish(f"{STATUS_PREFIX}{self.node_id}", status)
+
+    def _handle_command(self, header):
+        """Answers a request. Returns a reply payload, or None for requests not handled here."""
+        command = header.get("command")
+        security_system = self.security_system
+        caption_generator = self.caption_generator
+        archive = caption_generator.archive if caption_generator else None
+
+        if command == "alert_stats" and security_system:
+            streams = security_system.alert_aggregator.get_stats()
+            return {"status": "success", "streams": [dict(s, node_id=self.node_id) for s in streams]}
+        if command == "search" and archive:
+            if not header.get("query", "").strip():
+                return {"status": "error", "message": "Search query must not be empty"}
+            results = archive.search_text(caption_generator.embed_text(header["query"]),
+                                          max(1, header.get("top_k", 10)), header.get("start"), header.get("end"))
+            return {"status": "success", "total": len(archive),
+                    "results": [dict(r, node_id=self.node_id) for r in results]}
+        # Entry ids are per archive, so only the node that owns the entry answers
+        if command == "search_similar" and archive and header.get("node_id") in [None, self.node_id]:
+            results = archive.search_similar(header["entry_id"], max(1, header.get("top_k", 10)),
+                                             header.get("start"), header.get("end"))
+            return {"status": "success", "total": len(archive),
+                    "results": [dict(r, node_id=self.node_id) for r in results]}
+        return None
+
+    def _control_worker(self):
+        last_status = 0
+        while self.running:
+            message = self.control.recv(timeout=0.5)
+            if message is not None:
+                try:
+                    reply = self._handle_command(message.header)
+                except Exception as e:
+                    logger.error(f"Control command failed: {str(e)}")
+                    reply = {"status": "error", "message": str(e)}
+                reply_to = message.header.get("reply_to")
+                if reply is not None and reply_to:
+                    self.bus.publish(reply_to, {"request_id": message.header.get("request_id"),
+                                                "node_id": self.node_id, "result": reply})
+            if time.time() - last_status >= 1.0:
+                self._publish_status()
+                last_status = time.time()
+
+    def stop(self):
+        self.running = False
+        for thread in self.threads:
+            thread.join()
+        self.frames.close()
+        self.control.close()
+        self.cluster.stop()
+
+class ServingState:
+    """The web worker's view of the bus: shared state, latest frames and requests.
+
+    Web workers keep no authoritative state of their own, so any number of them
+    can run side by side; everything they report comes from the bus.
+    """
+    def __init__(self, bus, frame_buffer):
+        self.bus = bus
+        self.frame_buffer = frame_buffer
+        self.client_id = f"web-{uuid.uuid4().hex[:8]}"
+        self.reply_topic = f"replies/{self.client_id}"
+        self.lock = Lock()
+        self.latest_results = {}
+        self.viewers = {"caption": 0, "security": 0}
+        self.request_lock = Lock()
+        self.replies = bus.subscribe(self.reply_topic, conflate=False)
+        self.cluster = ClusterView(bus)
+        self.running = True
+        self.threads = [Thread(target=self._follow, args=(prefix,)) for prefix in ["results/", "frames/"]]
+        self.threads.append(Thread(target=self._demand_worker))
+        for thread in self.threads:
+            thread.daemon = True
+            thread.start()
+
+    def _follow(self, prefix):
+        subscription = self.bus.subscribe(prefix, conflate=True)
+        try:
+            while self.running:
+                message = subscription.recv(timeout=0.5)
+                if message is None:
+                    continue
+                camera_id = message.header.get("camera_id")
+                if prefix == "results/":
+                    with self.lock:
+                        self.latest_results[camera_id] = dict(message.header, received=time.time())
+                    self.frame_buffer.update_annotated(camera_id, message)
+                else:
+                    self.frame_buffer.update_raw(camera_id, message)
+        finally:
+            subscription.close()
+
+    def _publish_demand(self):
+        with self.lock:
+            demand = {kind: count > 0 for kind, count in self.viewers.items()}
+        self.bus.publish(f"{DEMAND_PREFIX}{self.client_id}", demand)
+
+    def _demand_worker(self):
+        while self.running:
+            self._publish_demand()
+            time.sleep(1.0)
+
+    def add_viewer(self, kind):
+        with self.lock:
+            self.viewers[kind] += 1
+        self._publish_demand()
+
+    def remove_viewer(self, kind):
+        with self.lock:
+            self.viewers[kind] -= 1
+        self._publish_demand()
+
+    def get_state(self, key):
+        return self.cluster.get_state(key)
+
+    def set_state(self, key, value):
+        publish_state(self.bus, key, value)
+
+    def get_caption(self):
+        """Latest caption reported by any live captioning node."""
+        for heartbeat in self.cluster.live_nodes("inference").values():
+            if "caption" in heartbeat:
+                return heartbeat["caption"]
+        return None
+
+    def get_latest_result(self, camera_id):
+        with self.lock:
+            return dict(self.latest_results.get(camera_id, {}))
+
+    def request(self, command, timeout=5.0, gather=False, capability=None, **fields):
+        """Publishes a request and waits for replies.
+
+        Returns the first reply, or with gather=True a list with the replies of
+        every live inference node (only those whose heartbeat sets `capability`,
+        if given), stopping early once all have answered.
+        Returns None / a partial list on timeout.
+        """
+        request_id = uuid.uuid4().hex
+        expected = set()
+        if gather:
+            expected = {node_id for node_id, heartbeat in self.cluster.live_nodes("inference").items()
+                        if capability is None or heartbeat.get(capability)}
+        replies = []
+        with self.request_lock:
+            self.bus.publish(CONTROL_TOPIC, dict(fields, command=command,
+                                                 request_id=request_id, reply_to=self.reply_topic))
+            deadline = time.time() + timeout
+            while time.time() < deadline:
+                message = self.replies.recv(timeout=deadline - time.time())
+                if message is None or message.header.get("request_id") != request_id:
+                    continue
+                if not gather:
+                    return message.header.get("result")
+                replies.append(message.header.get("result"))
+                expected.discard(message.header.get("node_id"))
+                if not expected:
+                    break
+        return replies if gather else None
+
+    def stop(self):
+        self.running = False
+        for thread in self.threads:
+            thread.join()
+        self.replies.close()
+        self.cluster.stop()
+
+def build_inference(bus, archive_dir="archive", cameras=None, captioning=True, always_on=False):
+    """Loads the models and starts an InferenceNode. Returns (node, caption_generator, security_system).
+
+    A node only captions if it can lock archive_dir, so several nodes sharing
+    a directory (e.g. on one box) never write the same archive files.
+    """
+    import torch
+    from core_logic import load_models, lock_directory, CaptionGenerator, SecuritySystem, CaptionArchive
+
+    archive_lock = lock_directory(archive_dir) if captioning else None
+    if captioning and archive_lock is None:
+        print(f"Archive {archive_dir} is in use by another node.")
+
+    if archive_lock:
+        print("Loading models...")
+        processor, model, device = load_models()
+    else:
+        processor, model, device = None, None, 'cuda' if torch.cuda.is_available() else 'cpu'
+    print("Initializing Security System...")
+    security_system = SecuritySystem(device)
+
+    caption_generator = None
+    if not archive_lock:
+        print("Captioning disabled on this node.")
+    elif processor and model:
+        print("Models loaded. Initializing CaptionGenerator...")
+        caption_archive = CaptionArchive(
+            archive_dir,
+            image_dim=model.config.vision_config.hidden_size,
+            text_dim=model.config.text_config.hidden_size,
+            lock_file=archive_lock,
+        )
+        caption_generator = CaptionGenerator(processor, model, device, archive=caption_archive)
+    else:
+        print("Failed to load models.")
+        archive_lock.close()  # Let another node caption into this archive
+
+    node = InferenceNode(bus, security_system, caption_generator, cameras=cameras, always_on=always_on)
+    return node, caption_generator, security_system
+
+def analyze_file(security_system, path, camera_id="video", keyframes_only=True):
+    """Scans a recorded file for people, unpaced. Yields (timestamp, zone, detections) per hit."""
+    for timestamp, frame in iter_frames(path, keyframes_only=keyframes_only):
+        _, detections = security_system.detect_persons(frame)
+        by_zone = {}
+        for box, conf in detections:
+            by_zone.setdefault(security_system.zone_for(camera_id, box, frame.shape), []).append((box, conf))
+        for zone, zone_detections in by_zone.items():
+            yield timestamp, zone, zone_detections
+
+def run_analysis(path, camera_id="video", keyframes_only=True):
+    """Prints every detection in a recorded file and a per-zone summary."""
+    import torch
+    from core_logic import SecuritySystem
+
+    device = 'cuda' if torch.cuda.is_available() else 'cpu'
+    security_system = SecuritySystem(device)
+    if not security_system.model:
+        print("Error: YOLO model is not available.")
+        return
+    summary = {}
+    start = time.time()
+    try:
+        for timestamp, zone, detections in analyze_file(security_system, path, camera_id, keyframes_only):
+            best_conf = max(conf for _, conf in detections)
+            print(f"{timestamp:9.2f}s  {zone}: {len(detections)} person(s), best confidence {best_conf:.2f}")
+            first, _, hits = summary.get(zone, (timestamp, timestamp, 0))
+            summary[zone] = (first, timestamp, hits + 1)
+    finally:
+        security_system.stop()
+
+    print(f"Analyzed {path} in {time.time() - start:.1f}s")
+    for zone, (first, last, hits) in summary.items():
+        print(f"  {zone}: {hits} frame(s) with people between {first:.2f}s and {last:.2f}s")
+
+def main():
+    parser = argparse.ArgumentParser(description="Run one MuseumGuard pipeline role.")
+    parser.add_argument("role", choices=["broker", "capture", "inference", "analyze"])
+    parser.add_argument("--bus", default="ipc:///tmp/museumguard", help="ipc:// or tcp:// bus URL")
+    parser.add_argument("--camera-id", default="webcam", help="capture/analyze: camera name (selects zones)")
+    parser.add_argument("--source", default=None, help="capture: camera index, 'auto' or video file")
+    parser.add_argument("--as-live", action="store_true",
+                        help="capture: treat a video file as a live camera (testing without cameras)")
+    parser.add_argument("--cameras", default=None, help="inference: comma-separated camera ids to own")
+    parser.add_argument("--archive-dir", default="archive", help="inference: caption archive directory")
+    parser.add_argument("--no-caption", action="store_true", help="inference: run security detection only")
+    parser.add_argument("--always-on", action="store_true",
+                        help="capture/inference: keep working even when no stream is viewed")
+    parser.add_argument("--file", default=None, help="analyze: recorded video to scan")
+    parser.add_argument("--all-frames", action="store_true", help="analyze: decode every frame, not just keyframes")
+    args = parser.parse_args()
+
+    if args.role == "broker":
+        run_broker(args.bus)
+        return
+    if args.role == "analyze":
+        if not args.file:
+            parser.error("analyze needs --file")
+        run_analysis(args.file, args.camera_id, keyframes_only=not args.all_frames)
+        return
+
+    bus = create_bus(args.bus)
+    cleanup = []
+    if args.role == "capture":
+        cleanup.append(CaptureNode(bus, args.camera_id, args.source, always_on=args.always_on,
+                                   as_live=args.as_live))
+    else:
+        cameras = args.cameras.split(",") if args.cameras else None
+        node, caption_generator, security_system = build_inference(
+            bus, archive_dir=args.archive_dir, cameras=cameras,
+            captioning=not args.no_caption, always_on=args.always_on)
+        cleanup.extend([node, security_system] + ([caption_generator] if caption_generator else []))
+
+    print(f"{args.role} node running on {args.bus}. Press Ctrl+C to stop.")
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        for item in cleanup:
+            item.stop()
+        bus.close()
+
+if __name__ == "__main__":
+    main()
@@ -3,6 +3,7 @@ const languageSelect = document.getElementById('language-select');
 const speakBtn = document.getElementById('speak-btn');
 const snapshotBtn = document.getElementById('snapshot-btn');
 const snapshotStatus = document.getElementById('snapshot-status');
+const snapshotGallery = document.getElementById('snapshot-gallery');
 
 let currentOriginalCaption = "";
 let currentDisplayCaption = "";
@@ -105,8 +106,37 @@ snapshotBtn.addEventListener('click', async () => {
         if (data.status === 'success') {
             snapshotStatus.innerText = "Saved";
             setTimeout(() => { snapshotStatus.innerText = ""; }, 2000);
+            loadSnapshotGallery();
         }
     } catch (e) {
         console.error(e);
     }
 });
+
+// Snapshot Gallery
+async function loadSnapshotGallery() {
+    try {
+        const res = await fetch('/snapshots?limit=8');
+        const data = await res.json();
+
+        snapshotGallery.innerHTML = "";
+        data.items.forEach(item => {
+            const link = document.createElement('a');
+            link.href = item.url;
+            link.target = '_blank';
+            link.title = new Date(item.timestamp * 1000).toLocaleString();
+
+            const img = document.createElement('img');
+            img.src = item.thumbnail_url;
+            img.loading = 'lazy';
+            img.alt = item.kind;
+
+            link.appendChild(img);
+            snapshotGallery.appendChild(link);
+        });
+    } catch (e) {
+        console.error(e);
+    }
+}
+
+loadSnapshotGallery();
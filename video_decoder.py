@@ -0,0 +1,220 @@
+import cv2
+import time
+import logging
+from threading import Thread, Event
+from queue import Queue, Empty, Full
+
+try:
+    import av  # Optional: PyAV gives multithreaded decode and keyframe seeking
+except ImportError:
+    av = None
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_FPS = 25.0
+
+class OpenCVDecoder:
+    """Decodes a video file with cv2.VideoCapture."""
+    def __init__(self, path):
+        self.path = path
+        self.capture = cv2.VideoCapture(path)
+        if not self.capture.isOpened():
+            raise IOError(f"Could not open video: {path}")
+        self.fps = self.capture.get(cv2.CAP_PROP_FPS) or DEFAULT_FPS
+
+    def read(self):
+        """Returns (frame, timestamp_seconds), or (None, None) at end of file."""
+        success, frame = self.capture.read()
+        if not success:
+            return None, None
+        return frame, self.capture.get(cv2.CAP_PROP_POS_MSEC) / 1000.0
+
+    def seek(self, seconds):
+        self.capture.set(cv2.CAP_PROP_POS_MSEC, seconds * 1000.0)
+
+    def release(self):
+        self.capture.release()
+
+class PyAVDecoder:
+    """Decodes a video file with PyAV using FFmpeg's frame/slice threading.
+
+    With keyframes_only=True the codec skips every non-key frame, which makes
+    scanning long evidence files far cheaper than decoding every frame.
+    """
+    def __init__(self, path, keyframes_only=False):
+        if av is None:
+            raise ImportError("PyAV is not installed (pip install av)")
+        self.path = path
+        self.container = av.open(path)
+        self.stream = self.container.streams.video[0]
+        self.stream.thread_type = "AUTO"
+        if keyframes_only:
+            self.stream.codec_context.skip_frame = "NONKEY"
+        self.fps = float(self.stream.average_rate or DEFAULT_FPS)
+        self.frames = self.container.decode(self.stream)
+
+    def read(self):
+        """Returns (frame, timestamp_seconds), or (None, None) at end of file.
+
+        The timestamp is None when the stream carries no pts for the frame.
+        """
+        try:
+            frame = next(self.frames)
+        except (StopIteration, av.error.EOFError):
+            return None, None
+        return frame.to_ndarray(format="bgr24"), (float(frame.time) if frame.time is not None else None)
+
+    def seek(self, seconds):
+        """Seeks to the nearest keyframe at or before the given time."""
+        offset = int(seconds / self.stream.time_base) if self.stream.time_base else 0
+        self.container.seek(offset, stream=self.stream, backward=True, any_frame=False)
+        self.frames = self.container.decode(self.stream)
+
+    def release(self):
+        self.container.close()
+
+class PrefetchingDecoder:
+    """Decodes ahead on a background thread into a bounded queue.
+
+    When paced, read() releases frames at the source FPS and drops frames that
+    are already late, so playback runs in real time regardless of how fast
+    inference is. Unpaced, every frame is returned as soon as it is decoded.
+    """
+    def __init__(self, decoder, queue_size=32, loop=True, paced=True):
+        self.decoder = decoder
+        self.fps = decoder.fps
+        self.loop = loop
+        self.paced = paced
+        self.frame_queue = Queue(maxsize=queue_size)
+        self.stop_event = Event()
+        self.finished = Event()
+
+        # Pacing clock: wall time at which the frame with timestamp clock_pts is due
+        self.clock_start = None
+        self.clock_pts = 0.0
+        self.last_pts = 0.0
+        self.last_read_time = 0
+
+        self.thread = Thread(target=self._decode_worker)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def _decode_worker(self):
+        # The decoder is only touched (and finally released) on this thread,
+        # so release() can never close it in the middle of a read
+        try:
+            decoded_since_seek = 0
+            last_pts = 0.0
+            while not self.stop_event.is_set():
+                try:
+                    frame, pts = self.decoder.read()
+                except Exception as e:
+                    logger.error(f"Decode error in {self.decoder.path}: {e}")
+                    frame, pts = None, None
+
+                if frame is None:
+                    # Stop at the end, or if the file yields no frames at all
+                    if not self.loop or decoded_since_seek == 0:
+                        break
+                    self.decoder.seek(0)
+                    decoded_since_seek = 0
+                    continue
+
+                # Missing or non-increasing timestamps (no pts, POS_MSEC stuck at 0)
+                # fall back to the frame index at the source FPS, so pacing still works
+                if decoded_since_seek > 0 and (pts is None or pts <= last_pts):
+                    pts = last_pts + 1.0 / self.fps
+                elif pts is None:
+                    pts = 0.0
+                last_pts = pts
+                decoded_since_seek += 1
+
+                while not self.stop_event.is_set():
+                    try:
+                        self.frame_queue.put((frame, pts), timeout=0.5)
+                        break
+                    except Full:
+                        continue
+        finally:
+            self.decoder.release()
+            self.finished.set()
+
+    def read_timestamped(self, timeout=1.0):
+        """Returns the next decoded (frame, timestamp_seconds) without pacing, or (None, None)."""
+        while True:
+            try:
+                return self.frame_queue.get(timeout=timeout)
+            except Empty:
+                if self.finished.is_set() or self.stop_event.is_set():
+                    return None, None
+
+    def read(self, timeout=1.0):
+        """Returns (success, frame), like cv2.VideoCapture.read()."""
+        frame, pts = self.read_timestamped(timeout)
+        if frame is None:
+            return False, None
+        if not self.paced:
+            return True, frame
+
+        now = time.time()
+        # Restart the clock on the first read, after a loop back to the start,
+        # or after the consumer paused (e.g. while the webcam was selected)
+        if self.clock_start is None or pts < self.last_pts or now - self.last_read_time > 1.0:
+            self.clock_start, self.clock_pts = now, pts
+
+        due = self.clock_start + (pts - self.clock_pts)
+        if due > now:
+            time.sleep(due - now)
+        else:
+            # Behind schedule: skip frames that are already late, keep the newest
+            late_by = now - due
+            while late_by > 1.0 / self.fps and not self.frame_queue.empty():
+                next_frame, next_pts = self.frame_queue.get_nowait()
+                if next_pts < pts:
+                    # Looped back to the start; show that frame on the next read
+                    self.clock_start = None
+                    frame = next_frame
+                    break
+                late_by -= next_pts - pts
+                frame, pts = next_frame, next_pts
+
+        self.last_pts = pts
+        self.last_read_time = time.time()
+        return True, frame
+
+    def release(self):
+        """Stops decoding; the worker thread releases the decoder once its current read returns."""
+        self.stop_event.set()
+        self.thread.join(timeout=2)
+
+def open_decoder(path, backend="auto", keyframes_only=False):
+    """Opens a raw decoder. backend is 'auto', 'pyav' or 'opencv'."""
+    if backend in ["auto", "pyav"] and av is not None:
+        try:
+            return PyAVDecoder(path, keyframes_only=keyframes_only)
+        except Exception as e:
+            if backend == "pyav":
+                raise
+            logger.warning(f"PyAV could not open {path} ({e}), falling back to OpenCV")
+    elif backend == "pyav":
+        raise ImportError("PyAV is not installed (pip install av)")
+    if keyframes_only:
+        logger.info(f"OpenCV cannot skip non-key frames; decoding every frame of {path}")
+    return OpenCVDecoder(path)
+
+def open_video(path, backend="auto", queue_size=32, loop=True, paced=True):
+    """Opens a file for playback with read-ahead decoding."""
+    return PrefetchingDecoder(open_decoder(path, backend), queue_size=queue_size, loop=loop, paced=paced)
+
+def iter_frames(path, backend="auto", keyframes_only=False, queue_size=64):
+    """Yields (timestamp_seconds, frame) for batch analysis, decoding ahead of the consumer."""
+    decoder = PrefetchingDecoder(open_decoder(path, backend, keyframes_only),
+                                 queue_size=queue_size, loop=False, paced=False)
+    try:
+        while True:
+            frame, pts = decoder.read_timestamped()
+            if frame is None:
+                break
+            yield pts, frame
+    finally:
+        decoder.release()